@@ -0,0 +1,34 @@
+import os
+import sys
+import functools
+
+# the bundled index only covers the airports we're likely to fly through; set
+# this to a fuller file in the same format to cover everything
+AIRPORT_TIMEZONES_PATH = os.environ.get(
+    "V3CLI_AIRPORT_TIMEZONES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "airport_timezones.tsv"),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def airport_timezone_index():
+    """Load the IATA code -> IANA timezone index the first time it's needed"""
+    index = {}
+    with open(AIRPORT_TIMEZONES_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            code, timezone = line.rstrip("\n").split("\t")
+            # lots of airports share a handful of zones, so only keep one copy
+            # of each timezone string around
+            index[code] = sys.intern(timezone)
+
+    return index
+
+
+def timezone_for_airport(airport_code):
+    """Return the IANA timezone name for an airport code, or None if unknown"""
+    if not airport_code:
+        return None
+
+    return airport_timezone_index().get(airport_code.strip().upper())
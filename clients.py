@@ -0,0 +1,12 @@
+import functools
+
+import nylas as nylasSDK
+
+
+@functools.lru_cache(maxsize=None)
+def nylas_client(api_key):
+    """Return a Nylas client for the API key, reusing it for the life of the process
+
+    Scripts only run one command per process anyway, but v3cli_daemon runs many
+    and shouldn't have to set up a new client for each."""
+    return nylasSDK.Client(api_key=api_key)
@@ -5,6 +5,8 @@ import click
 
 import nylas as nylasSDK
 
+from clients import nylas_client
+
 NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
 if not NYLAS_API_KEY:
     raise Exception("Please set the NYLAS_API_KEY environment variable")
@@ -23,7 +25,7 @@ def user_inputs_y(message):
 )
 def delete_test_events(grant_id, yes, notify):
     """Delete all events on the primary calendar matching the title 'test event'"""
-    nylas = nylasSDK.Client(api_key=NYLAS_API_KEY)
+    nylas = nylas_client(NYLAS_API_KEY)
 
     test_events, request_id, next_cursor = nylas.events.list(
         identifier=grant_id,
@@ -6,11 +6,14 @@ import tiktoken
 import os
 import re
 import email
+import datetime
 import functools
 import time
 
 from strip_tags import strip_tags
 
+from mail_archives import decoded_header, iter_maildir_candidates, iter_mbox_candidates
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = "gpt-3.5-turbo-16k"
 OPENAI_TOKEN_LIMIT = 16385
@@ -104,6 +107,18 @@ JSON_SCHEMA = {
     "required": ["flight_details", "passenger_details", "purchase_summary"],
 }
 
+# the format JSON_SCHEMA pins departure_datetime and arrival_datetime to, i.e.
+# "%a, %b %d, %Y %I:%M %p"
+FLIGHT_DATETIME_RE = re.compile(
+    r"^[A-Za-z]{3}, ([A-Za-z]{3}) (\d{1,2}), (\d{4}) (\d{1,2}):(\d{2}) ([AaPp][Mm])$"
+)
+MONTH_ABBREVIATIONS = {
+    abbreviation: number
+    for number, abbreviation in enumerate(
+        "jan feb mar apr may jun jul aug sep oct nov dec".split(), start=1
+    )
+}
+
 
 def time_this_function(func):
     @functools.wraps(func)
@@ -118,6 +133,34 @@ def time_this_function(func):
     return wrapper
 
 
+def parse_flight_datetime(datetime_str):
+    """Parse a datetime in the format JSON_SCHEMA asks for into a naive datetime
+
+    Much cheaper than strptime or dateutil since the format is fixed. Returns
+    None if the string doesn't match, so callers can fall back to a generic
+    parser."""
+    match = FLIGHT_DATETIME_RE.match(datetime_str.strip())
+    if not match:
+        return None
+
+    month_abbreviation, day, year, hour, minute, meridiem = match.groups()
+    month = MONTH_ABBREVIATIONS.get(month_abbreviation.lower())
+    if month is None:
+        return None
+
+    hour = int(hour)
+    if not 1 <= hour <= 12:
+        return None
+    hour %= 12
+    if meridiem.upper() == "PM":
+        hour += 12
+
+    try:
+        return datetime.datetime(int(year), month, int(day), hour, int(minute))
+    except ValueError:
+        return None
+
+
 def email_body_only(email_text):
     msg = email.message_from_string(email_text)
     body_content = []
@@ -132,16 +175,20 @@ def email_body_only(email_text):
             if content_type == "text/plain" or content_type == "text/html":
                 body_content.append(
                     part.get_payload(decode=True).decode(
-                        part.get_content_charset(), errors="replace"
+                        part.get_content_charset() or "utf-8", errors="replace"
                     )
                 )
 
     return "\n\n".join(body_content)
 
 
+@functools.lru_cache(maxsize=None)
+def openai_encoding():
+    return tiktoken.encoding_for_model(OPENAI_MODEL)
+
+
 def count_tokens(text):
-    enc = tiktoken.encoding_for_model(OPENAI_MODEL)
-    return len(enc.encode(text))
+    return len(openai_encoding().encode(text))
 
 
 def strip_tags_from_email(email_content):
@@ -229,6 +276,32 @@ def extract_flight_details(email_text, anthropic=False):
         return {}
 
 
+def extract_from_archive(candidates, anthropic):
+    """Extract and print flight details for each (headers, message text) candidate
+
+    One bad message (or API error) doesn't stop the rest of the archive from
+    being processed; it's reported and skipped."""
+    failures = 0
+    for headers, email_text in candidates:
+        subject = decoded_header(headers.get("Subject"))
+        sender = decoded_header(headers.get("From"))
+        print("==> {} from {}".format(subject, sender))
+        try:
+            flight_details_json = extract_flight_details(email_text, anthropic)
+        except Exception as e:
+            failures += 1
+            print("Failed to extract from {} from {}: {}".format(subject, sender, e))
+            continue
+
+        if flight_details_json:
+            print(json.dumps(flight_details_json, indent=4))
+        else:
+            print("No flight details found")
+
+    if failures:
+        print("Failed to extract from {} messages".format(failures))
+
+
 @click.command()
 @click.option(
     "-e",
@@ -236,6 +309,29 @@ def extract_flight_details(email_text, anthropic=False):
     type=click.Path(exists=True),
     help="Path to the input .eml email file",
 )
+@click.option(
+    "--mbox",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Path to an mbox archive to extract from instead",
+)
+@click.option(
+    "--maildir",
+    type=click.Path(exists=True, file_okay=False),
+    help="Path to a Maildir to extract from instead",
+)
+@click.option(
+    "--from-domain",
+    "from_domains",
+    multiple=True,
+    help="With --mbox/--maildir, only look at messages from these domains",
+)
+@click.option(
+    "--subject-keyword",
+    "-k",
+    "subject_keywords",
+    multiple=True,
+    help="With --mbox/--maildir, only look at messages with one of these words in the subject",
+)
 @click.option(
     "-a",
     "--anthropic",
@@ -243,7 +339,26 @@ def extract_flight_details(email_text, anthropic=False):
     default=False,
     help="Use Anthropic to parse instead of OpenAI",
 )
-def main(email, anthropic):
+def main(email, mbox, maildir, from_domains, subject_keywords, anthropic):
+    if len([source for source in (email, mbox, maildir) if source]) != 1:
+        raise click.UsageError(
+            "Please give exactly one of --email, --mbox or --maildir"
+        )
+
+    # archives can be huge, so messages are filtered on their headers before
+    # anything else gets parsed
+    if mbox:
+        extract_from_archive(
+            iter_mbox_candidates(mbox, from_domains, subject_keywords), anthropic
+        )
+        return
+    if maildir:
+        extract_from_archive(
+            iter_maildir_candidates(maildir, from_domains, subject_keywords),
+            anthropic,
+        )
+        return
+
     try:
         with open(email, "r", encoding="utf-8") as email_file:
             email_text = email_file.read()
@@ -0,0 +1,70 @@
+import base64
+
+from extract_flight_info import extract_flight_details
+from itinerary import write_itinerary
+
+
+def sender_emails(participants):
+    """Return the lowercased email addresses from a list of Nylas participants
+
+    Handles both SDK objects and the plain dicts that show up in webhook payloads."""
+    emails = []
+    for participant in participants or []:
+        if isinstance(participant, dict):
+            address = participant.get("email")
+        else:
+            address = getattr(participant, "email", None)
+        if address:
+            emails.append(address.lower())
+
+    return emails
+
+
+def is_from(participants, from_emails):
+    """Whether any of the senders is one of from_emails
+
+    An entry in from_emails starting with @ matches that domain and its
+    subdomains, e.g. @united.com matches receipts@mail.united.com."""
+    wanted = [address.lower() for address in from_emails]
+    for address in sender_emails(participants):
+        domain = address.rpartition("@")[2]
+        for want in wanted:
+            if address == want or (
+                want.startswith("@")
+                and (domain == want[1:] or domain.endswith("." + want[1:]))
+            ):
+                return True
+
+    return False
+
+
+def fetch_email_text(nylas, grant_id, message_id):
+    """Download the full raw MIME for a message, which is what extract_flight_details wants"""
+    message, request_id = nylas.messages.find(
+        identifier=grant_id,
+        message_id=message_id,
+        query_params=dict(fields="raw_mime"),
+    )
+    raw_mime = message.raw_mime
+    # raw_mime comes back base64url encoded, sometimes without padding
+    raw_mime += "=" * (-len(raw_mime) % 4)
+
+    return base64.urlsafe_b64decode(raw_mime).decode("utf-8", errors="replace")
+
+
+def schedule_flights_from_message(nylas, grant_id, message_id, trip_event=True):
+    """Extract flight details from a message and put them on the grant's primary calendar
+
+    Returns the created events, or an empty list if there weren't any flights."""
+    email_text = fetch_email_text(nylas, grant_id, message_id)
+    flight_details = extract_flight_details(email_text)
+    flights = (flight_details or {}).get("flight_details") or []
+    if not flights:
+        print("No flight details found in message {}".format(message_id))
+        return []
+
+    events = write_itinerary(nylas, grant_id, flights, trip_event=trip_event)
+    for event in events:
+        print("Event created with ID: {}".format(event.id))
+
+    return events
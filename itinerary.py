@@ -0,0 +1,324 @@
+import os
+import json
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from dateutil import parser
+
+from airports import timezone_for_airport
+from extract_flight_info import parse_flight_datetime
+from message_state import STATE_DIR
+
+# one log file per itinerary being written, removed once it's either fully
+# written or fully rolled back
+TRANSACTION_LOG_DIR = os.path.join(STATE_DIR, "itineraries")
+
+# logs of the itineraries this process is writing right now, which recovery
+# has to leave alone even though they're named after our own PID
+_live_log_paths = set()
+_live_log_paths_lock = threading.Lock()
+
+
+def flight_time(datetime_str, airport_code):
+    """Return (unix timestamp, timezone name) for a flight time local to the given airport
+
+    The timezone name is None if we don't know the airport, in which case the
+    time is interpreted in the local timezone."""
+    timezone = timezone_for_airport(airport_code)
+    if timezone is None:
+        print(
+            "Warning: don't know the timezone for airport {}, using local time for {}".format(
+                airport_code, datetime_str
+            )
+        )
+
+    dt = parse_flight_datetime(datetime_str)
+    if dt is None:
+        # not in the format we asked for, so fall back to the slow generic parser
+        dt = parser.parse(datetime_str)
+
+    if timezone and dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo(timezone))
+
+    return int(dt.timestamp()), timezone
+
+
+def flight_event_body(flight):
+    """Build the events.create request body for a single flight leg"""
+    start_unix_timestamp, start_timezone = flight_time(
+        flight["departure_datetime"], flight.get("departure_city_airport_code")
+    )
+    end_unix_timestamp, end_timezone = flight_time(
+        flight["arrival_datetime"], flight.get("arrival_city_airport_code")
+    )
+
+    when = {
+        "start_time": start_unix_timestamp,
+        "end_time": end_unix_timestamp,
+    }
+    if start_timezone:
+        when["start_timezone"] = start_timezone
+    if end_timezone:
+        when["end_timezone"] = end_timezone
+
+    return dict(
+        title="Flight {} {}->{}".format(
+            flight["flight_number"],
+            flight["departure_city_airport_code"],
+            flight["arrival_city_airport_code"],
+        ),
+        description=json.dumps(flight, indent=4),
+        when=when,
+    )
+
+
+def local_date(unix_timestamp, timezone):
+    """Return the YYYY-MM-DD date of a timestamp in the given timezone (or local time)"""
+    tzinfo = ZoneInfo(timezone) if timezone else None
+    return datetime.fromtimestamp(unix_timestamp, tzinfo).date().isoformat()
+
+
+def trip_event_body(flights):
+    """Build the events.create request body for an all-day event spanning the whole trip"""
+    first_flight, last_flight = flights[0], flights[-1]
+    start_unix_timestamp, start_timezone = flight_time(
+        first_flight["departure_datetime"],
+        first_flight.get("departure_city_airport_code"),
+    )
+    end_unix_timestamp, end_timezone = flight_time(
+        last_flight["arrival_datetime"], last_flight.get("arrival_city_airport_code")
+    )
+
+    airport_codes = [first_flight["departure_city_airport_code"]] + [
+        flight["arrival_city_airport_code"] for flight in flights
+    ]
+
+    return dict(
+        title="Trip {}".format("->".join(airport_codes)),
+        description="\n".join(
+            "Flight {} {}->{}".format(
+                flight["flight_number"],
+                flight["departure_city_airport_code"],
+                flight["arrival_city_airport_code"],
+            )
+            for flight in flights
+        ),
+        when={
+            "start_date": local_date(start_unix_timestamp, start_timezone),
+            "end_date": local_date(end_unix_timestamp, end_timezone),
+        },
+    )
+
+
+class ItineraryTransaction:
+    """Keeps track of the events created for an itinerary so they can be
+    deleted again if any part of it fails to be created
+
+    Created event IDs are also appended to a log file, so if the process dies
+    before it can roll back, recover_interrupted_itineraries can finish the
+    job later. The file is named after the process writing it, so recovery
+    can tell which ones are still in progress."""
+
+    def __init__(self, nylas, grant_id, calendar_id, log_dir=TRANSACTION_LOG_DIR):
+        self.nylas = nylas
+        self.grant_id = grant_id
+        self.calendar_id = calendar_id
+        self.log_path = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            self.log_path = os.path.join(
+                log_dir, "{}-{}.jsonl".format(os.getpid(), uuid.uuid4().hex)
+            )
+            with _live_log_paths_lock:
+                _live_log_paths.add(os.path.abspath(self.log_path))
+        self.created_event_ids = []
+        self._lock = threading.Lock()
+
+    def _log(self, action, event_id):
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(
+                    json.dumps(
+                        dict(
+                            action=action,
+                            grant_id=self.grant_id,
+                            calendar_id=self.calendar_id,
+                            event_id=event_id,
+                        )
+                    )
+                    + "\n"
+                )
+
+    def create(self, request_body):
+        event, request_id = self.nylas.events.create(
+            identifier=self.grant_id,
+            request_body=request_body,
+            query_params=dict(
+                calendar_id=self.calendar_id,
+            ),
+        )
+        with self._lock:
+            self.created_event_ids.append(event.id)
+            self._log("created", event.id)
+        return event
+
+    def _destroy(self, event_id):
+        destroy_event(self.nylas, self.grant_id, self.calendar_id, event_id)
+        with self._lock:
+            self._log("deleted", event_id)
+
+    def rollback(self, executor):
+        """Delete every event created so far, returning the IDs that couldn't be deleted"""
+        with self._lock:
+            event_ids = list(self.created_event_ids)
+
+        futures = {
+            executor.submit(self._destroy, event_id): event_id for event_id in event_ids
+        }
+        wait(futures)
+
+        return [
+            event_id for future, event_id in futures.items() if future.exception()
+        ]
+
+    def release(self):
+        """Stop treating the transaction as in progress, so recovery can pick up
+        anything it left behind"""
+        if self.log_path:
+            with _live_log_paths_lock:
+                _live_log_paths.discard(os.path.abspath(self.log_path))
+
+    def finish(self):
+        """Forget about the transaction, once there's nothing left to undo"""
+        self.release()
+        if self.log_path and os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+
+def destroy_event(nylas, grant_id, calendar_id, event_id):
+    nylas.events.destroy(
+        grant_id,
+        event_id,
+        dict(calendar_id=calendar_id, notify_participants=False),
+    )
+
+
+def process_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def recover_interrupted_itineraries(nylas, log_dir=TRANSACTION_LOG_DIR):
+    """Delete events left behind by itineraries whose process died partway through
+
+    Logs belonging to processes that are still running are left alone, since
+    those itineraries may still be being written."""
+    if not log_dir or not os.path.isdir(log_dir):
+        return
+
+    for name in sorted(os.listdir(log_dir)):
+        pid = name.partition("-")[0]
+        if not name.endswith(".jsonl") or not pid.isdigit():
+            continue
+        log_path = os.path.join(log_dir, name)
+        if int(pid) == os.getpid():
+            # PIDs get reused (a container's PID 1 every run), so our own PID
+            # only means in progress if it's one of ours that's still going
+            with _live_log_paths_lock:
+                if os.path.abspath(log_path) in _live_log_paths:
+                    continue
+        elif process_is_running(int(pid)):
+            continue
+
+        with open(log_path, "r") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+
+        deleted = {
+            entry["event_id"] for entry in entries if entry["action"] == "deleted"
+        }
+        left_behind = [
+            entry
+            for entry in entries
+            if entry["action"] == "created" and entry["event_id"] not in deleted
+        ]
+
+        failed = False
+        for entry in left_behind:
+            print(
+                "Deleting event {} left behind by an interrupted itinerary".format(
+                    entry["event_id"]
+                )
+            )
+            try:
+                destroy_event(
+                    nylas, entry["grant_id"], entry["calendar_id"], entry["event_id"]
+                )
+            except Exception as e:
+                print("Couldn't delete event {}: {}".format(entry["event_id"], e))
+                failed = True
+                continue
+            with open(log_path, "a") as f:
+                f.write(json.dumps(dict(entry, action="deleted")) + "\n")
+
+        if not failed:
+            os.remove(log_path)
+
+
+def write_itinerary(
+    nylas,
+    grant_id,
+    flights,
+    calendar_id="primary",
+    trip_event=True,
+    log_dir=TRANSACTION_LOG_DIR,
+):
+    """Create events for every flight leg (plus an all-day trip event) concurrently
+
+    Either all of the events are created, or none are: if any of them fails,
+    the ones that did get created are deleted again and the original error is
+    re-raised. Returns the created events, trip event last."""
+    if not flights:
+        return []
+
+    # build all the request bodies up front so a bad flight fails before we
+    # touch the calendar at all
+    request_bodies = [flight_event_body(flight) for flight in flights]
+    if trip_event:
+        request_bodies.append(trip_event_body(flights))
+
+    transaction = ItineraryTransaction(nylas, grant_id, calendar_id, log_dir)
+
+    with ThreadPoolExecutor(max_workers=len(request_bodies)) as executor:
+        futures = [executor.submit(transaction.create, body) for body in request_bodies]
+        # wait for everything, even after a failure, so we know about every
+        # event that actually got created before rolling back
+        wait(futures)
+
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            print(
+                "Failed to create {} of {} events, rolling back".format(
+                    len(errors), len(request_bodies)
+                )
+            )
+            left_behind = transaction.rollback(executor)
+            if left_behind:
+                print(
+                    "Couldn't delete events with IDs: {}".format(", ".join(left_behind))
+                )
+                transaction.release()
+            else:
+                transaction.finish()
+            raise errors[0]
+
+    transaction.finish()
+    return [future.result() for future in futures]
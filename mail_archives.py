@@ -0,0 +1,137 @@
+import os
+import mmap
+import email.utils
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+
+MBOX_SEPARATOR = b"\nFrom "
+
+
+def mbox_message_spans(mm):
+    """Yield (start, end) byte offsets of each message in a memory-mapped mbox
+
+    Offsets skip the "From " envelope line, so mm[start:end] is the message
+    itself. Only the separators are scanned for, nothing gets copied."""
+    size = len(mm)
+    start = 0 if mm[:5] == b"From " else mm.find(MBOX_SEPARATOR)
+    if start == -1:
+        return
+    if start > 0:
+        start += 1
+
+    while start < size:
+        next_separator = mm.find(MBOX_SEPARATOR, start)
+        end = size if next_separator == -1 else next_separator + 1
+
+        envelope_end = mm.find(b"\n", start, end)
+        if envelope_end != -1:
+            yield envelope_end + 1, end
+
+        start = end
+
+
+def header_block_end(buffer, start, end):
+    """Return the offset where the headers of the message at buffer[start:end] stop
+
+    Whichever kind of blank line comes first ends the headers, since a message
+    with CRLF headers can still have bare LF blank lines further down."""
+    ends = []
+    for blank_line in (b"\n\n", b"\r\n\r\n"):
+        position = buffer.find(blank_line, start, end)
+        if position != -1:
+            ends.append(position + len(blank_line))
+
+    return min(ends, default=end)
+
+
+def parse_headers(header_bytes):
+    return BytesHeaderParser().parsebytes(header_bytes)
+
+
+def decoded_header(value):
+    if value is None:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except (UnicodeError, LookupError, ValueError):
+        return str(value)
+
+
+def headers_match(headers, from_domains, subject_keywords):
+    """Whether a message looks worth a full parse, going by its headers alone
+
+    An empty from_domains or subject_keywords lets everything through for that
+    check."""
+    if from_domains:
+        # parse the raw header: decoding first can turn an encoded display
+        # name like "United Airlines, Inc." into something parseaddr splits
+        # on, and only the address is needed here anyway
+        name, address = email.utils.parseaddr(str(headers.get("From", "")))
+        domain = address.rpartition("@")[2].lower()
+        if not any(
+            domain == wanted.lower().lstrip("@")
+            or domain.endswith("." + wanted.lower().lstrip("@"))
+            for wanted in from_domains
+        ):
+            return False
+
+    if subject_keywords:
+        subject = decoded_header(headers.get("Subject")).lower()
+        if not any(keyword.lower() in subject for keyword in subject_keywords):
+            return False
+
+    return True
+
+
+def iter_mbox_candidates(path, from_domains=(), subject_keywords=()):
+    """Yield (headers, message text) for messages in an mbox file that pass
+    headers_match
+
+    The file is memory-mapped and only the headers of each message are parsed
+    until it's known to be a candidate, so memory use doesn't grow with the
+    size of the archive."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start, end in mbox_message_spans(mm):
+                headers = parse_headers(mm[start : header_block_end(mm, start, end)])
+                if headers_match(headers, from_domains, subject_keywords):
+                    yield headers, mm[start:end].decode("utf-8", errors="replace")
+
+
+def read_header_bytes(f):
+    """Read lines from the start of a message file up to and including the blank
+    line that ends the headers"""
+    lines = []
+    for line in f:
+        lines.append(line)
+        if line in (b"\n", b"\r\n"):
+            break
+
+    return b"".join(lines)
+
+
+def maildir_message_paths(path):
+    for subdir in ("cur", "new"):
+        directory = os.path.join(path, subdir)
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith("."):
+                    yield entry.path
+
+
+def iter_maildir_candidates(path, from_domains=(), subject_keywords=()):
+    """Yield (headers, message text) for messages in a Maildir that pass
+    headers_match, only reading the rest of a message file if it does"""
+    for message_path in maildir_message_paths(path):
+        with open(message_path, "rb") as f:
+            headers = parse_headers(read_header_bytes(f))
+            if not headers_match(headers, from_domains, subject_keywords):
+                continue
+            f.seek(0)
+            message_text = f.read().decode("utf-8", errors="replace")
+
+        yield headers, message_text
@@ -0,0 +1,159 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+
+STATE_DIR = os.environ.get("V3CLI_STATE_DIR", os.path.expanduser("~/.v3cli_state"))
+
+# how many times to try a message before giving up on it for good
+MAX_ATTEMPTS = 3
+
+
+def query_key(from_emails, subject_keywords):
+    """A short stable name for a set of senders and subject keywords"""
+    query = json.dumps(
+        dict(
+            from_emails=sorted(address.lower() for address in from_emails),
+            subject_keywords=sorted(keyword.lower() for keyword in subject_keywords),
+        )
+    )
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+
+
+class MessageState:
+    """Remembers which messages have already been processed for a grant
+
+    seen_message_ids (message ID -> received date) holds every message that's
+    been turned into calendar events, or given up on. It's shared by every
+    query and by watch_flight_emails, since creating events isn't idempotent
+    and a message should only ever be scheduled once. Only messages that got
+    as far as extraction go in it, so it stays small.
+
+    The high-water marks are kept per query (the senders and subject keywords
+    being looked for), since getting through all of one sender's mail says
+    nothing about another's. A mark means everything received before it has
+    been dealt with for that query.
+
+    failures counts attempts at messages that haven't worked yet, so one that
+    will never work is eventually given up on instead of being retried forever.
+
+    Several processes can share a grant's state: save() merges what this
+    instance changed into whatever's on disk, under a lock."""
+
+    def __init__(self, grant_id, state_dir=STATE_DIR):
+        self.grant_id = grant_id
+        self.path = os.path.join(
+            state_dir, "{}.json".format(re.sub(r"[^A-Za-z0-9_.-]", "_", grant_id))
+        )
+        self.received_after_marks = {}
+        self.seen_message_ids = {}
+        self.failures = {}
+        # what this instance changed, to merge in on save
+        self._changed_marks = {}
+        self._changed_seen = {}
+        self._changed_failures = {}
+
+        state = self._read()
+        self.received_after_marks = state["received_after_marks"]
+        self.seen_message_ids = state["seen_message_ids"]
+        self.failures = state["failures"]
+
+    def _read(self):
+        state = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                state = json.loads(f.read() or "{}")
+
+        return dict(
+            received_after_marks=state.get("received_after_marks", {}),
+            seen_message_ids=state.get("seen_message_ids", {}),
+            failures=state.get("failures", {}),
+        )
+
+    def received_after(self, from_emails, subject_keywords):
+        return self.received_after_marks.get(query_key(from_emails, subject_keywords))
+
+    def set_received_after(self, from_emails, subject_keywords, received_after):
+        key = query_key(from_emails, subject_keywords)
+        self.received_after_marks[key] = received_after
+        self._changed_marks[key] = received_after
+
+    def is_seen(self, message_id):
+        return message_id in self.seen_message_ids
+
+    def mark_seen(self, message_id, date):
+        self.seen_message_ids[message_id] = date
+        self._changed_seen[message_id] = date
+
+    def record_failure(self, message_id, date):
+        """Count a failed attempt at a message, returning True if it should be
+        tried again or False if it's been given up on (and marked seen)"""
+        attempts = self.failures.get(message_id, 0) + 1
+        self.failures[message_id] = attempts
+        self._changed_failures[message_id] = attempts
+        if attempts < MAX_ATTEMPTS:
+            return True
+
+        print(
+            "Warning: giving up on message {} after {} failed attempts".format(
+                message_id, attempts
+            )
+        )
+        self.mark_seen(message_id, date)
+        return False
+
+    def pending_failures(self):
+        """IDs of messages that failed but haven't been given up on yet"""
+        return [
+            message_id
+            for message_id in self.failures
+            if message_id not in self.seen_message_ids
+        ]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            state = self._read()
+            state["received_after_marks"].update(self._changed_marks)
+            state["seen_message_ids"].update(self._changed_seen)
+            for message_id, attempts in self._changed_failures.items():
+                state["failures"][message_id] = max(
+                    attempts, state["failures"].get(message_id, 0)
+                )
+            # failures only matter until the message is dealt with
+            state["failures"] = {
+                message_id: attempts
+                for message_id, attempts in state["failures"].items()
+                if message_id not in state["seen_message_ids"]
+            }
+
+            # write to a temp file and swap it in so a crash can't leave a
+            # half-written state file behind
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(dict(grant_id=self.grant_id, **state)))
+            os.replace(tmp_path, self.path)
+
+        self.received_after_marks = state["received_after_marks"]
+        self.seen_message_ids = state["seen_message_ids"]
+        self.failures = state["failures"]
+        self._changed_marks = {}
+        self._changed_seen = {}
+        self._changed_failures = {}
+
+
+def grant_states(state_dir=STATE_DIR):
+    """Yield the saved MessageState of every grant that has one"""
+    if not os.path.isdir(state_dir):
+        return
+
+    for name in sorted(os.listdir(state_dir)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(state_dir, name), "r") as f:
+            grant_id = json.loads(f.read() or "{}").get("grant_id")
+        if grant_id:
+            yield MessageState(grant_id, state_dir)
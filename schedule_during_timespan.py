@@ -8,6 +8,8 @@ import arrow
 
 import nylas as nylasSDK
 
+from clients import nylas_client
+
 # TODO / wishlist: support buffers between scheduled meetings, abide by the
 # user's configured working hours (not supported via Nylas yet), limiting the
 # number of meetings scheduled per day (to e.g. 2), other strategies to prevent
@@ -18,7 +20,7 @@ NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
 if not NYLAS_API_KEY:
     raise Exception("Please set the NYLAS_API_KEY environment variable")
 
-nylas = nylasSDK.Client(api_key=NYLAS_API_KEY)
+nylas = nylas_client(NYLAS_API_KEY)
 
 
 def unix_to_friendly_datetime(unix_timestamp):
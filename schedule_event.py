@@ -6,6 +6,8 @@ from dateutil import parser
 
 import nylas as nylasSDK
 
+from clients import nylas_client
+
 NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
 if not NYLAS_API_KEY:
     raise Exception("Please set the NYLAS_API_KEY environment variable")
@@ -23,7 +25,7 @@ if not NYLAS_API_KEY:
 )
 def schedule_event(email, title, description, start, end, grant_id, notify):
     """Schedule an event with Nylas"""
-    nylas = nylasSDK.Client(api_key=NYLAS_API_KEY)
+    nylas = nylas_client(NYLAS_API_KEY)
 
     start_unix_timestamp = int(parser.parse(start).timestamp())
     end_unix_timestamp = int(parser.parse(end).timestamp())
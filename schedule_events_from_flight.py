@@ -4,11 +4,11 @@ import json
 
 import click
 
-from dateutil import parser
-
 import nylas as nylasSDK
 
+from clients import nylas_client
 from extract_flight_info import extract_flight_details
+from itinerary import recover_interrupted_itineraries, write_itinerary
 
 NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
 if not NYLAS_API_KEY:
@@ -29,12 +29,17 @@ if not NYLAS_API_KEY:
     help="Read email details from cache instead of calling OpenAI API",
 )
 @click.option("--grant-id", "-g", default="me", help="Grant ID")
-def main(email, grant_id, read_from_cache):
+@click.option(
+    "--trip-event/--no-trip-event",
+    default=True,
+    help="Whether to also add an all-day event spanning the whole trip",
+)
+def main(email, grant_id, read_from_cache, trip_event):
     """Schedule calendar events corresponding to the flight details on the grant's primary calendar"""
     with open(email, "r", encoding="utf-8") as email_file:
         email_text = email_file.read()
 
-    nylas = nylasSDK.Client(api_key=NYLAS_API_KEY)
+    nylas = nylas_client(NYLAS_API_KEY)
 
     if read_from_cache:
         with open("flight_details.json", "r") as f:
@@ -46,8 +51,8 @@ def main(email, grant_id, read_from_cache):
     with open("flight_details.json", "w") as f:
         f.write(json.dumps(flight_details, indent=4))
 
-    # step 1: we just wanna put calendar events for the flight itself on the calendar
-    # later we'll also add an all-day event with the trip name too
+    # we put calendar events for each flight on the calendar, plus an all-day
+    # event with the trip name
     # the contents of flight_details is a dict that looks like this:
     # {
     # "flight_details": [
@@ -65,11 +70,8 @@ def main(email, grant_id, read_from_cache):
     #     ]
     # }
 
-    # write the code that uses nylas.events.create and the above details to create
-    # events for each flight
-    # convert the departure_datetime and arrival_datetime to unix timestamps using arrow library
-
-    for flight in flight_details["flight_details"]:
+    flights = flight_details["flight_details"]
+    for flight in flights:
         print(
             "processing flight {} departing {} from {}".format(
                 flight["flight_number"],
@@ -77,31 +79,14 @@ def main(email, grant_id, read_from_cache):
                 flight["departure_city"],
             )
         )
-        start_unix_timestamp = int(
-            parser.parse(flight["departure_datetime"]).timestamp()
-        )
-        end_unix_timestamp = int(parser.parse(flight["arrival_datetime"]).timestamp())
 
-        description = json.dumps(flight, indent=4)
+    # clean up after any earlier run that died halfway through writing a trip
+    recover_interrupted_itineraries(nylas)
 
-        event, request_id = nylas.events.create(
-            identifier=grant_id,
-            request_body=dict(
-                title="Flight {} {}->{}".format(
-                    flight["flight_number"],
-                    flight["departure_city_airport_code"],
-                    flight["arrival_city_airport_code"],
-                ),
-                description=description,
-                when={
-                    "start_time": start_unix_timestamp,
-                    "end_time": end_unix_timestamp,
-                },
-            ),
-            query_params=dict(
-                calendar_id="primary",
-            ),
-        )
+    # all the legs are created at once, and if any of them fail the rest are
+    # deleted again so we never leave half a trip on the calendar
+    events = write_itinerary(nylas, grant_id, flights, trip_event=trip_event)
+    for event in events:
         print("Event created with ID: {}".format(event.id))
 
 
@@ -8,7 +8,9 @@ from dateutil import parser
 
 import nylas as nylasSDK
 
-from extract_flight_info import extract_flight_details
+from clients import nylas_client
+from flight_emails import is_from, schedule_flights_from_message
+from message_state import MessageState
 
 NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
 if not NYLAS_API_KEY:
@@ -18,11 +20,51 @@ if not NYLAS_API_KEY:
 import logging
 import requests
 
-# Set up logging to print out HTTP request information
-logging.basicConfig(level=logging.DEBUG)
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.DEBUG)
-requests_log.propagate = True
+
+def log_http_requests():
+    """Set up logging to print out HTTP request information
+
+    Only done when run as a script, so importing this (e.g. from v3cli_daemon)
+    doesn't turn on debug logging for everything else in the process."""
+    logging.basicConfig(level=logging.DEBUG)
+    requests_log = logging.getLogger("requests.packages.urllib3")
+    requests_log.setLevel(logging.DEBUG)
+    requests_log.propagate = True
+
+
+# only ask for what we need to decide whether a message is worth downloading
+MESSAGE_LIST_FIELDS = "id,grant_id,date,subject,from"
+
+
+def list_new_messages(nylas, grant_id, from_emails, received_after):
+    """List every message from the given senders received after the given time,
+    following pagination, oldest first"""
+    query_params = dict(
+        any_email=",".join(from_emails),
+        select=MESSAGE_LIST_FIELDS,
+    )
+    if received_after is not None:
+        query_params["received_after"] = received_after
+
+    messages = []
+    while True:
+        page, request_id, next_cursor = nylas.messages.list(
+            identifier=grant_id,
+            query_params=query_params,
+        )
+        messages.extend(page)
+        if not next_cursor:
+            break
+        query_params["page_token"] = next_cursor
+
+    return sorted(messages, key=lambda message: message.date)
+
+
+def subject_matches(subject, subject_keywords):
+    if not subject_keywords:
+        return True
+    subject = (subject or "").lower()
+    return any(keyword.lower() in subject for keyword in subject_keywords)
 
 
 @click.command()
@@ -40,22 +82,83 @@ requests_log.propagate = True
     help="Read email details from cache instead of calling OpenAI API",
 )
 @click.option("--grant-id", "-g", default="me", help="Grant ID")
-def main(from_emails, grant_id, read_from_cache):
-    """Schedule calendar events corresponding to the flight details on the grant's primary calendar"""
-    nylas = nylasSDK.Client(api_key=NYLAS_API_KEY)
-
-    messages, request_id, next_cursor = nylas.messages.list(
-        identifier=grant_id,
-        query_params=dict(
-            any_email=from_emails,
-        ),
+@click.option(
+    "--subject-keyword",
+    "-k",
+    "subject_keywords",
+    multiple=True,
+    help="Only process messages with one of these words in the subject",
+)
+@click.option(
+    "--since",
+    help="Only look at messages received after this date, instead of picking up where the last run left off",
+)
+@click.option(
+    "--reprocess",
+    is_flag=True,
+    default=False,
+    help="Ignore saved progress and look at every message again",
+)
+def main(from_emails, grant_id, read_from_cache, subject_keywords, since, reprocess):
+    """Schedule calendar events corresponding to the flight details on the grant's primary calendar
+
+    Progress is saved between runs, so each run only processes mail that has
+    arrived since the last one, and a message is never scheduled twice unless
+    --reprocess is given."""
+    nylas = nylas_client(NYLAS_API_KEY)
+
+    state = MessageState(grant_id)
+    if since:
+        received_after = int(parser.parse(since).timestamp())
+    elif reprocess:
+        received_after = None
+    else:
+        received_after = state.received_after(from_emails, subject_keywords)
+
+    # received_after might not include messages received at exactly that time,
+    # so ask from a second before; anything already dealt with is skipped below
+    messages = list_new_messages(
+        nylas,
+        grant_id,
+        from_emails,
+        received_after - 1 if received_after is not None else None,
     )
 
+    # the mark can't move past the first message that still needs another try
+    retry_date = None
     for message in messages:
+        if state.is_seen(message.id) and not reprocess:
+            continue
+        # any_email also matches messages *to* those addresses, and subjects
+        # are only filtered here. Neither gets recorded as seen, so a later
+        # run with different options still gets to look at them
+        if not is_from(getattr(message, "from_", None), from_emails):
+            continue
+        if not subject_matches(message.subject, subject_keywords):
+            continue
+
         print("Message: {} {}".format(message.date, message.subject))
+        try:
+            schedule_flights_from_message(nylas, grant_id, message.id)
+        except Exception as e:
+            print("Error processing message {}: {}".format(message.id, e))
+            if state.record_failure(message.id, message.date) and retry_date is None:
+                retry_date = message.date
+            continue
+        state.mark_seen(message.id, message.date)
 
+    if retry_date is not None:
+        state.set_received_after(from_emails, subject_keywords, retry_date)
+    elif messages:
+        state.set_received_after(
+            from_emails,
+            subject_keywords,
+            max(messages[-1].date, received_after or 0),
+        )
+    state.save()
 
 if __name__ == "__main__":
+    log_http_requests()
     try:
         main()
     except nylasSDK.models.errors.NylasApiError as e:
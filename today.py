@@ -6,6 +6,8 @@ import click
 
 import nylas as nylasSDK
 
+from clients import nylas_client
+
 NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
 if not NYLAS_API_KEY:
     raise Exception("Please set the NYLAS_API_KEY environment variable")
@@ -34,7 +36,7 @@ def timespan_to_human_readable(timespan):
 @click.option("--grant-id", "-g", default="me", help="Grant ID")
 def today(grant_id):
     """Display all the events I have today"""
-    nylas = nylasSDK.Client(api_key=NYLAS_API_KEY)
+    nylas = nylas_client(NYLAS_API_KEY)
 
     today = arrow.now()
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Run any of the scripts in this repo by command name, e.g. `v3cli.py today -g me`
+
+If v3cli_daemon.py is running, the command is forwarded to it over a Unix
+socket and runs in the already-warm daemon. Otherwise the script is just run
+directly. This file deliberately only uses the standard library so that it
+starts up fast."""
+import os
+import sys
+import json
+import socket
+
+SOCKET_PATH = os.environ.get("V3CLI_SOCKET", os.path.expanduser("~/.v3cli.sock"))
+
+# command name -> (module, click command in that module)
+COMMANDS = {
+    "today": ("today", "today"),
+    "schedule-event": ("schedule_event", "schedule_event"),
+    "schedule-during-timespan": ("schedule_during_timespan", "main"),
+    "delete-test-events": ("delete_test_events", "delete_test_events"),
+    "extract": ("extract_flight_info", "main"),
+    "schedule-events-from-flight": ("schedule_events_from_flight", "main"),
+    "schedule-flight-events-from-recent-emails": (
+        "schedule_flight_events_from_recent_emails",
+        "main",
+    ),
+}
+
+# commands that ask for confirmation on stdin unless given one of these options,
+# which needs a real terminal rather than the daemon
+PROMPTING_COMMANDS = {
+    "delete-test-events": ("-y", "--yes"),
+}
+
+
+class DaemonRefused(Exception):
+    pass
+
+
+def run_in_daemon(argv):
+    """Send argv to the daemon and stream its output back, returning the exit code
+
+    Raises DaemonRefused if the daemon can't run the command the same way
+    running the script directly would, e.g. because it's in another directory."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(SOCKET_PATH)
+
+    request = dict(argv=argv, cwd=os.getcwd(), stdin_isatty=sys.stdin.isatty())
+    with sock, sock.makefile("r", encoding="utf-8") as responses:
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+
+        # the daemon sends back one JSON object per line: chunks of output
+        # tagged with which stream they were written to, then the exit code
+        for line in responses:
+            response = json.loads(line)
+            if "refused" in response:
+                raise DaemonRefused(response["refused"])
+            if "exit_code" in response:
+                return response["exit_code"]
+            stream = sys.stderr if response["stream"] == "stderr" else sys.stdout
+            stream.write(response["data"])
+            stream.flush()
+
+    print("Lost connection to v3cli daemon", file=sys.stderr)
+    return 1
+
+
+def run_directly(argv):
+    """Replace this process with the script for the command"""
+    module, function = COMMANDS[argv[0]]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), module + ".py")
+    os.execv(sys.executable, [sys.executable, script] + argv[1:])
+
+
+def main():
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS:
+        print("Usage: v3cli.py COMMAND [ARGS]...", file=sys.stderr)
+        print("Commands: {}".format(", ".join(COMMANDS)), file=sys.stderr)
+        return 2
+
+    try:
+        return run_in_daemon(argv)
+    except (OSError, DaemonRefused):
+        # no daemon running (or a stale, unreachable or otherwise unusable
+        # socket), or it can't run this one for us
+        run_directly(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import json
+import time
+import socket
+import importlib
+import threading
+import traceback
+import socketserver
+
+import click
+
+import nylas as nylasSDK
+
+from clients import nylas_client
+from extract_flight_info import openai_encoding
+from v3cli import COMMANDS, PROMPTING_COMMANDS, SOCKET_PATH
+
+NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
+if not NYLAS_API_KEY:
+    raise Exception("Please set the NYLAS_API_KEY environment variable")
+
+# commands that only read, so it's ok to serve a recent result from cache
+CACHEABLE_COMMANDS = {"today"}
+
+
+class ThreadLocalStream:
+    """Stands in for sys.stdout/sys.stderr so that each request's thread writes
+    to its own client, and everything else writes where it always did"""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def redirect(self, stream):
+        self._local.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, "stream", None) or self._default, name)
+
+
+class ClientStream:
+    """A text stream that forwards everything written to it to the client"""
+
+    encoding = "utf-8"
+    errors = "strict"
+
+    def __init__(self, request, name, lock, transcript):
+        self.request = request
+        self.name = name
+        self.lock = lock
+        self.transcript = transcript
+
+    def write(self, data):
+        if not isinstance(data, str):
+            raise TypeError("write() argument must be str")
+        if data:
+            with self.lock:
+                self.transcript.append((self.name, data))
+                self.request.sendall(
+                    (json.dumps(dict(stream=self.name, data=data)) + "\n").encode(
+                        "utf-8"
+                    )
+                )
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def refusal_reason(request):
+    """Return why the daemon shouldn't run a request itself, or None if it can
+
+    Commands have to run in the same directory the client is in, since they
+    take relative paths and write files like flight_details.json, and anything
+    that may read stdin has to run where the client's stdin actually is."""
+    argv = request["argv"]
+    if os.path.realpath(request.get("cwd") or "") != os.path.realpath(os.getcwd()):
+        return "running in a different directory"
+    if not request.get("stdin_isatty", True):
+        return "stdin is not a terminal"
+    skip_prompt_options = PROMPTING_COMMANDS.get(argv[0])
+    if skip_prompt_options is not None and not any(
+        arg.startswith(option) for arg in argv[1:] for option in skip_prompt_options
+    ):
+        return "{} may prompt for input".format(argv[0])
+
+    return None
+
+
+def run_command(command, argv):
+    """Run a click command in-process, returning its exit code"""
+    try:
+        result = command.main(args=argv[1:], prog_name=argv[0], standalone_mode=False)
+        return result if isinstance(result, int) else 0
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        print("Aborted!", file=sys.stderr)
+        return 1
+    except nylasSDK.models.errors.NylasApiError as e:
+        print("Nylas API error: {}".format(e))
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def send(self, response):
+        self.request.sendall((json.dumps(response) + "\n").encode("utf-8"))
+
+    def replay(self, transcript):
+        for name, data in transcript:
+            self.send(dict(stream=name, data=data))
+
+    def handle(self):
+        line = self.rfile.readline()
+        # another daemon starting up checks whether we're here by connecting
+        # and hanging up without sending anything
+        if not line:
+            return
+        request = json.loads(line)
+        argv = request["argv"]
+        command = self.server.commands.get(argv[0])
+        if command is None:
+            self.send(
+                dict(stream="stderr", data="Unknown command {}\n".format(argv[0]))
+            )
+            self.send(dict(exit_code=2))
+            return
+
+        # the client runs the script itself instead
+        reason = refusal_reason(request)
+        if reason:
+            self.send(dict(refused=reason))
+            return
+
+        cache_key = tuple(argv)
+        cached = self.server.cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < self.server.cache_ttl:
+            timestamp, transcript, exit_code = cached
+            self.replay(transcript)
+            self.send(dict(exit_code=exit_code))
+            return
+
+        transcript = []
+        lock = threading.Lock()
+        sys.stdout.redirect(ClientStream(self.request, "stdout", lock, transcript))
+        sys.stderr.redirect(ClientStream(self.request, "stderr", lock, transcript))
+        try:
+            exit_code = run_command(command, argv)
+        finally:
+            sys.stdout.redirect(None)
+            sys.stderr.redirect(None)
+
+        if argv[0] in CACHEABLE_COMMANDS and exit_code == 0:
+            self.server.cache[cache_key] = (time.monotonic(), transcript, exit_code)
+
+        self.send(dict(exit_code=exit_code))
+
+
+class CommandServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, commands, cache_ttl):
+        self.commands = commands
+        self.cache_ttl = cache_ttl
+        # argv -> (when it ran, output, exit code)
+        self.cache = {}
+        super().__init__(socket_path, CommandHandler)
+
+
+def daemon_is_listening(socket_path):
+    """Whether something is already answering on socket_path, as opposed to it
+    being left over from a daemon that didn't get to clean up"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def load_commands():
+    """Import every script up front, so it's already done when a command comes in"""
+    commands = {}
+    for name, (module, function) in COMMANDS.items():
+        commands[name] = getattr(importlib.import_module(module), function)
+
+    return commands
+
+
+@click.command()
+@click.option(
+    "--socket", "socket_path", default=SOCKET_PATH, help="Socket to listen on"
+)
+@click.option(
+    "--cache-ttl",
+    default=30,
+    type=int,
+    help="How many seconds to reuse results of read-only commands (0 to disable)",
+)
+def main(socket_path, cache_ttl):
+    """Keep the scripts in this repo loaded and warm in the background, and run
+    commands sent to it by v3cli.py over a Unix socket
+
+    Only commands sent from the directory the daemon was started in are run
+    here; v3cli.py runs anything else directly."""
+    if daemon_is_listening(socket_path):
+        raise click.ClickException(
+            "Another daemon is already listening on {}".format(socket_path)
+        )
+
+    commands = load_commands()
+
+    # do all the slow setup now rather than on the first command
+    nylas_client(NYLAS_API_KEY)
+    openai_encoding()
+
+    # check again, since another daemon may have started while we were busy;
+    # only a socket nothing is listening on is left over and safe to replace
+    if os.path.exists(socket_path):
+        if daemon_is_listening(socket_path):
+            raise click.ClickException(
+                "Another daemon is already listening on {}".format(socket_path)
+            )
+        os.unlink(socket_path)
+
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    sys.stderr = ThreadLocalStream(sys.stderr)
+    # nothing run here should ever read the daemon's own stdin, which would
+    # stop a backgrounded daemon dead
+    sys.stdin = io.StringIO("")
+
+    # anyone who can connect can run commands with our API key, so make sure
+    # the socket is created private rather than tightening it up afterwards
+    old_umask = os.umask(0o177)
+    try:
+        server = CommandServer(socket_path, commands, cache_ttl)
+    finally:
+        os.umask(old_umask)
+    print("Listening on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+import os
+import hmac
+import json
+import time
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import click
+
+import nylas as nylasSDK
+
+from clients import nylas_client
+from flight_emails import is_from, schedule_flights_from_message
+from itinerary import recover_interrupted_itineraries
+from message_state import MessageState, grant_states
+
+NYLAS_API_KEY = os.environ.get("NYLAS_API_KEY")
+if not NYLAS_API_KEY:
+    raise Exception("Please set the NYLAS_API_KEY environment variable")
+
+# the secret Nylas gives you when you create the webhook, used to check that
+# notifications really came from Nylas
+NYLAS_WEBHOOK_SECRET = os.environ.get("NYLAS_WEBHOOK_SECRET")
+
+# message.created.truncated is what Nylas sends instead of message.created
+# when the message is too big to fit in the notification
+MESSAGE_CREATED_TYPES = ("message.created", "message.created.truncated")
+
+# how many processed message IDs to remember for spotting redeliveries
+MAX_SEEN_MESSAGE_IDS = 10000
+
+# seconds to wait before each retry of a message that failed (OpenAI timeout,
+# Nylas rate limit, ...); Nylas has already had its 200 by then, so it won't
+# send the message again itself
+RETRY_DELAYS = (5, 30, 120)
+
+
+def signature_is_valid(body, signature, secret):
+    """Check the X-Nylas-Signature header, a hex HMAC-SHA256 of the raw body"""
+    if not signature:
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+
+class FlightEmailWorkers:
+    """A fixed number of threads pulling messages to process off a bounded queue
+
+    If the queue is full we'd rather tell Nylas to try again later than pile up
+    an unbounded backlog of LLM calls."""
+
+    def __init__(self, nylas, num_workers, max_queued, trip_event):
+        self.nylas = nylas
+        self.trip_event = trip_event
+        self.queue = queue.Queue(maxsize=max_queued)
+        # Nylas can deliver the same notification more than once. Messages are
+        # only remembered once they've been dealt with, so a redelivery of one
+        # that failed gets another go; only the most recent ones are kept so
+        # this doesn't grow forever. The grant's MessageState is the lasting
+        # record, shared with schedule_flight_events_from_recent_emails
+        self.seen_message_ids = OrderedDict()
+        self.in_progress_message_ids = set()
+        self.seen_lock = threading.Lock()
+        for _ in range(num_workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def enqueue(self, grant_id, message_id, date=None):
+        """Queue a message for processing, returning False if there's no room"""
+        with self.seen_lock:
+            if (
+                message_id in self.seen_message_ids
+                or message_id in self.in_progress_message_ids
+            ):
+                print("Already seen message {}, skipping".format(message_id))
+                return True
+            try:
+                self.queue.put_nowait((grant_id, message_id, date))
+            except queue.Full:
+                return False
+            self.in_progress_message_ids.add(message_id)
+
+        return True
+
+    def mark_done(self, message_id, succeeded):
+        with self.seen_lock:
+            self.in_progress_message_ids.discard(message_id)
+            if succeeded:
+                self.seen_message_ids[message_id] = True
+                self.seen_message_ids.move_to_end(message_id)
+                while len(self.seen_message_ids) > MAX_SEEN_MESSAGE_IDS:
+                    self.seen_message_ids.popitem(last=False)
+
+    def process(self, grant_id, message_id, date):
+        """Schedule a message's flights, retrying with backoff if it fails
+
+        Returns whether the message has been dealt with. Failures are saved to
+        the grant's MessageState, so they're tried again after a restart (or by
+        the polling script) until they've used up their attempts."""
+        if date is None:
+            date = int(time.time())
+
+        if MessageState(grant_id).is_seen(message_id):
+            print("Already processed message {}, skipping".format(message_id))
+            return True
+
+        for delay in RETRY_DELAYS + (None,):
+            try:
+                print("Processing message {}".format(message_id))
+                schedule_flights_from_message(
+                    self.nylas, grant_id, message_id, trip_event=self.trip_event
+                )
+            except nylasSDK.models.errors.NylasApiError as e:
+                print("Nylas API error processing {}: {}".format(message_id, e))
+            except Exception as e:
+                print("Error processing {}: {}".format(message_id, e))
+            else:
+                state = MessageState(grant_id)
+                state.mark_seen(message_id, date)
+                state.save()
+                return True
+
+            if delay is not None:
+                print("Retrying message {} in {}s".format(message_id, delay))
+                time.sleep(delay)
+
+        state = MessageState(grant_id)
+        gave_up = not state.record_failure(message_id, date)
+        state.save()
+        return gave_up
+
+    def work(self):
+        while True:
+            grant_id, message_id, date = self.queue.get()
+            succeeded = False
+            try:
+                succeeded = self.process(grant_id, message_id, date)
+            except Exception as e:
+                print("Error processing {}: {}".format(message_id, e))
+            finally:
+                self.mark_done(message_id, succeeded)
+                self.queue.task_done()
+
+    def retry_saved_failures(self, grant_id=None):
+        """Queue up messages that failed before we were last stopped"""
+        for state in grant_states():
+            if grant_id and state.grant_id != grant_id:
+                continue
+            for message_id in state.pending_failures():
+                print("Retrying message {} that failed earlier".format(message_id))
+                if not self.enqueue(state.grant_id, message_id):
+                    return
+
+
+def make_handler(workers, from_emails, grant_id, secret):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def respond(self, status, body=b""):
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # Nylas checks the endpoint when the webhook is created by sending
+            # a challenge that we have to echo back
+            challenge = parse_qs(urlparse(self.path).query).get("challenge")
+            if not challenge:
+                self.respond(400)
+                return
+            self.respond(200, challenge[0].encode("utf-8"))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            if secret and not signature_is_valid(
+                body, self.headers.get("X-Nylas-Signature"), secret
+            ):
+                print("Ignoring notification with a bad signature")
+                self.respond(401)
+                return
+
+            try:
+                notification = json.loads(body)
+            except ValueError:
+                self.respond(400)
+                return
+            if not isinstance(notification, dict):
+                self.respond(400)
+                return
+
+            if notification.get("type") not in MESSAGE_CREATED_TYPES:
+                self.respond(200)
+                return
+
+            data = notification.get("data")
+            message = data.get("object") if isinstance(data, dict) else None
+            if not isinstance(message, dict) or not message.get("id"):
+                print("Ignoring malformed notification")
+                self.respond(400)
+                return
+
+            message_grant_id = message.get("grant_id")
+            if grant_id and message_grant_id != grant_id:
+                self.respond(200)
+                return
+
+            if not is_from(message.get("from"), from_emails):
+                self.respond(200)
+                return
+
+            print(
+                "Message from {}: {}".format(
+                    message.get("from"), message.get("subject")
+                )
+            )
+            if workers.enqueue(message_grant_id, message["id"], message.get("date")):
+                self.respond(200)
+            else:
+                print("Too many messages queued, asking Nylas to retry later")
+                self.respond(503)
+
+    return WebhookHandler
+
+
+@click.command()
+@click.option(
+    "--from-emails",
+    multiple=True,
+    required=True,
+    help="Emails (or @domains) to extract flight details from",
+)
+@click.option("--grant-id", "-g", help="Only handle messages for this grant ID")
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", "-p", default=8000, type=int, help="Port to listen on")
+@click.option(
+    "--workers", default=4, type=int, help="How many messages to process at once"
+)
+@click.option(
+    "--max-queued",
+    default=100,
+    type=int,
+    help="How many messages can wait for a worker before we start turning them away",
+)
+@click.option(
+    "--trip-event/--no-trip-event",
+    default=True,
+    help="Whether to also add an all-day event spanning the whole trip",
+)
+@click.option(
+    "--no-verify",
+    is_flag=True,
+    default=False,
+    help="Skip webhook signature verification (for posting test payloads locally)",
+)
+def main(
+    from_emails, grant_id, host, port, workers, max_queued, trip_event, no_verify
+):
+    """Listen for Nylas message.created webhooks and schedule calendar events for
+    any flight confirmations from the given senders as they arrive"""
+    if not NYLAS_WEBHOOK_SECRET and not no_verify:
+        raise click.UsageError(
+            "Please set the NYLAS_WEBHOOK_SECRET environment variable, or pass --no-verify"
+        )
+
+    nylas = nylas_client(NYLAS_API_KEY)
+    recover_interrupted_itineraries(nylas)
+    flight_email_workers = FlightEmailWorkers(nylas, workers, max_queued, trip_event)
+    flight_email_workers.retry_saved_failures(grant_id)
+    secret = None if no_verify else NYLAS_WEBHOOK_SECRET
+
+    server = ThreadingHTTPServer(
+        (host, port), make_handler(flight_email_workers, from_emails, grant_id, secret)
+    )
+    print("Listening for webhooks on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()